@@ -0,0 +1,21 @@
+# export_artifacts.py
+# Gera, a partir dos artefatos do treino, os arquivos que a API carrega na subida.
+# Rode novamente sempre que `lead_scorer_model.pkl` ou `model_columns.pkl` forem re-treinados.
+
+import pickle
+import joblib
+from features import build_column_indices
+
+# --- Booster em formato nativo do XGBoost ---
+# Carregar o JSON do booster é mais rápido e leve do que desserializar o XGBClassifier
+# inteiro (que traz o sklearn junto) em cada worker do uvicorn.
+model = joblib.load('lead_scorer_model.pkl')
+model.get_booster().save_model('lead_scorer_model.json')
+print("Booster salvo em lead_scorer_model.json")
+
+# --- Índices de colunas prontos para uso ---
+# A API só desserializa os dicionários, sem reconstruí-los a cada subida.
+model_columns = joblib.load('model_columns.pkl')
+with open('indices.pkl', 'wb') as f:
+    pickle.dump(build_column_indices(model_columns), f, protocol=5)
+print("Índices de colunas salvos em indices.pkl")
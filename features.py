@@ -0,0 +1,28 @@
+# features.py
+# Definições de features compartilhadas entre a API (main.py) e o export dos artefatos.
+
+UTM_FIELDS = ['utm_campaign', 'utm_content', 'utm_medium', 'utm_source', 'utm_term']
+
+# O XGBoost não aceita '[', ']' ou '<' nos nomes das colunas; no treino elas foram trocadas por '_'.
+_COLUMN_TRANS = str.maketrans({'[': '_', ']': '_', '<': '_'})
+
+def sanitize_column(name: str) -> str:
+    """Aplica ao nome da coluna a mesma limpeza usada no treino do modelo."""
+    return name.translate(_COLUMN_TRANS)
+
+def build_column_indices(model_columns: list) -> tuple:
+    """Monta (COL_INDEX, SANITIZED_COLUMNS, OHE) a partir das colunas do treino.
+
+    OHE indexa o one-hot por (posição do campo em UTM_FIELDS, valor já sanitizado) -> coluna,
+    para não montar f"{campo}_{valor}" a cada predição.
+    """
+    sanitized_columns = [sanitize_column(col) for col in model_columns]
+    col_index = {col: i for i, col in enumerate(sanitized_columns)}
+
+    ohe = {}
+    for field_id, field in enumerate(UTM_FIELDS):
+        prefix = f"{field}_"
+        for i, col in enumerate(sanitized_columns):
+            if col.startswith(prefix):
+                ohe[(field_id, col[len(prefix):])] = i
+    return col_index, sanitized_columns, ohe
@@ -1,17 +1,56 @@
 # main.py (Versão de TESTE com segurança do webhook simplificada)
 
-import pandas as pd
-import joblib
-import re
+import numpy as np
+import pickle
+import xgboost as xgb
 import os
-import requests
-from fastapi import FastAPI, Request, Depends, HTTPException
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import asyncio
+from collections import OrderedDict
+import httpx
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Depends, HTTPException, BackgroundTasks
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import secrets
+from pydantic import BaseModel
+from features import UTM_FIELDS, sanitize_column
+
+# --- Logging ---
+# Os handlers só enfileiram o registro; a escrita no console (stderr) acontece na thread do QueueListener,
+# sem travar o event loop (iniciado/parado no lifespan).
+_log_queue = queue.Queue(-1)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+log_listener = QueueListener(_log_queue, _log_handler)
+logging.getLogger().addHandler(QueueHandler(_log_queue))
+logger = logging.getLogger("lead_scoring")
+logger.setLevel(logging.INFO)
 
 # --- Carregar Artefatos e Configurações ---
-model = joblib.load('lead_scorer_model.pkl')
-model_columns = joblib.load('model_columns.pkl')
+# Índices de colunas já montados por export_artifacts.py (ver features.build_column_indices).
+with open('indices.pkl', 'rb') as f:
+    COL_INDEX, SANITIZED_COLUMNS, _OHE = pickle.load(f)
+VALOR_INDEX = COL_INDEX['valor']
+N_COLUMNS = len(SANITIZED_COLUMNS)
+
+# Booster nativo (gerado por export_artifacts.py): cada worker do uvicorn (`--workers $WEB_CONCURRENCY`)
+# carrega só as árvores, sem desserializar o XGBClassifier e o sklearn junto.
+# Uma única linha por chamada, então uma thread basta e poupa o overhead do OpenMP.
+# A predição fica no predictor nativo do XGBoost: compilar as árvores (treelite/tl2cgen) exigiria
+# um compilador C e um .so gerado no deploy, e o custo por linha hoje é dominado pelo overhead fixo
+# de cada chamada, que o micro-batching já amortiza.
+booster = xgb.Booster()
+booster.load_model('lead_scorer_model.json')
+booster.set_param({"nthread": 1})
+
+# indices.pkl e lead_scorer_model.json são gerados juntos por export_artifacts.py; se só um deles for
+# atualizado, a ordem das colunas deixa de bater e (com validate_features=False) os scores saem errados.
+if booster.feature_names is None or [sanitize_column(col) for col in booster.feature_names] != SANITIZED_COLUMNS:
+    raise RuntimeError("indices.pkl não corresponde a lead_scorer_model.json; rode export_artifacts.py novamente.")
 
 PIPEDRIVE_API_KEY = os.getenv('PIPEDRIVE_API_KEY')
 LEAD_SCORE_FIELD_KEY = os.getenv('LEAD_SCORE_FIELD_KEY')
@@ -20,9 +59,47 @@ WEBHOOK_PASSWORD = os.getenv('WEBHOOK_PASSWORD')
 
 TARGET_PIPELINE_ID = 1
 
-app = FastAPI(title="API de Lead Scoring em Tempo Real", version="2.3.0-debug-auth")
+# Novas tentativas do update no Pipedrive em falhas transitórias (rede, 429, 5xx).
+PIPEDRIVE_MAX_RETRIES = 3
+PIPEDRIVE_RETRY_BASE_DELAY = 0.5  # segundos; dobra a cada tentativa
+
+# Linha zerada de referência: copiar (memcpy) sai mais barato que alocar e zerar a cada predição.
+_ZERO_ROW = np.zeros((1, N_COLUMNS), dtype=np.float32)
+_ZERO_ROW.flags.writeable = False
+
+# --- Ciclo de Vida da Aplicação ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Cria os recursos compartilhados na subida da API e os libera no desligamento."""
+    log_listener.start()
+    # A predição é CPU-bound; roda num pool próprio para não travar o event loop.
+    # Uma thread basta: o PredictionBatcher processa um lote por vez (e reaproveita um único buffer).
+    app.state.inference_pool = ThreadPoolExecutor(max_workers=1)
+    # Cliente HTTP único: reaproveita conexões (keep-alive/TLS) com o Pipedrive entre webhooks.
+    # O token vai no header (e não na URL) para não aparecer em logs de erro.
+    app.state.pd_client = httpx.AsyncClient(
+        base_url="https://api.pipedrive.com",
+        headers={"x-api-token": PIPEDRIVE_API_KEY} if PIPEDRIVE_API_KEY else None,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=20),
+    )
+    # Agrupa as predições concorrentes dos webhooks numa única chamada ao booster.
+    app.state.batcher = PredictionBatcher(app.state.inference_pool)
+    app.state.batcher.start()
+    yield
+    await app.state.batcher.stop()
+    await app.state.pd_client.aclose()
+    app.state.inference_pool.shutdown(wait=True)
+    log_listener.stop()
+
+app = FastAPI(title="API de Lead Scoring em Tempo Real", version="2.3.0-debug-auth", lifespan=lifespan)
 security = HTTPBasic()
 
+# Modelo de resposta dos endpoints: com `response_model`, o FastAPI serializa direto pelo Pydantic.
+class StatusResponse(BaseModel):
+    status: str
+    message: str
+
 # ==============================================================================
 #           >> FUNÇÃO DE SEGURANÇA TEMPORARIAMENTE SIMPLIFICADA <<
 # ==============================================================================
@@ -30,60 +107,181 @@ security = HTTPBasic()
 # Ela serve para testar se o resto do sistema funciona, isolando o problema 401.
 # ATENÇÃO: Não use esta versão em produção a longo prazo.
 
-def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
+async def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)) -> bool:
     """
     ATENÇÃO: Versão de teste que sempre permite o acesso.
     Isso é apenas para diagnosticar o problema 401.
     """
-    print(">>> AVISO DE SEGURANÇA: Autenticação de webhook está em modo de teste (sempre permitindo).")
+    logger.warning(">>> AVISO DE SEGURANÇA: Autenticação de webhook está em modo de teste (sempre permitindo).")
     # A função simplesmente retorna True, bypassando a verificação de usuário e senha.
     return True
 # ==============================================================================
 
 
 # --- Função de Lógica de Predição ---
-def get_prediction_for_deal(deal_data: dict) -> float:
-    """Recebe um dicionário com dados de um negócio e retorna a probabilidade de ganho."""
-    input_df = pd.DataFrame([deal_data])
-    input_df_dummies = pd.get_dummies(input_df, columns=['utm_campaign', 'utm_content', 'utm_medium', 'utm_source', 'utm_term'])
-    
-    final_df = pd.DataFrame(columns=model_columns).fillna(0)
-    final_df = pd.concat([final_df, input_df_dummies], ignore_index=True, sort=False).fillna(0)
-    final_df['ciclo_em_dias'] = 0
-    final_df = final_df[model_columns]
+def deal_key(deal_data: dict) -> tuple:
+    """Reduz o negócio às features usadas pelo modelo: (valor, utm_campaign, utm_content, utm_medium, utm_source, utm_term)."""
+    return (float(deal_data['valor']),) + tuple(deal_data[field] for field in UTM_FIELDS)
+
+def build_features(valor: float, utm_campaign: str, utm_content: str, utm_medium: str, utm_source: str, utm_term: str) -> np.ndarray:
+    """Monta a linha (1, n_colunas) em float32 na ordem das colunas do treino."""
+    x = _ZERO_ROW.copy()
+    row = x[0]  # view 1-D: indexar com um único inteiro é o caminho mais curto do NumPy
+    row[VALOR_INDEX] = valor
+
+    # One-hot das UTMs: marca apenas as colunas conhecidas pelo modelo; valores novos ficam zerados.
+    # Quase todo valor já bate direto com a coluna; só os que não batem passam pela sanitização
+    # (as colunas sanitizadas nunca contêm '[', ']' ou '<', então não há falso positivo).
+    get_column = _OHE.get
+    for field_id, value in enumerate((utm_campaign, utm_content, utm_medium, utm_source, utm_term)):
+        i = get_column((field_id, value))
+        if i is None:
+            i = get_column((field_id, sanitize_column(str(value))))
+        if i is not None:
+            row[i] = 1.0
+    return x
+
+def predict_rows(x: np.ndarray) -> np.ndarray:
+    """Probabilidade de ganho para cada linha de `x`."""
+    # Com objective 'binary:logistic' o booster já devolve P(classe=1).
+    return booster.inplace_predict(x, validate_features=False)
+
+# Cache LRU dos scores: webhooks repetidos do mesmo negócio (troca de etapa com mesmo valor/UTMs)
+# não passam pelo modelo. É explícito (e não lru_cache) para ser preenchido também pelo batcher.
+# Só é acessado a partir do event loop, então dispensa lock.
+SCORE_CACHE_SIZE = 10_000
+_score_cache: "OrderedDict[tuple, float]" = OrderedDict()
 
-    regex = re.compile(r"\[|\]|<", re.IGNORECASE)
-    final_df.columns = [regex.sub("_", col) for col in final_df.columns.values]
+def get_cached_score(key: tuple):
+    probability = _score_cache.get(key)
+    if probability is not None:
+        _score_cache.move_to_end(key)
+    return probability
 
-    probability = model.predict_proba(final_df)[:, 1][0]
-    return float(probability)
+def cache_score(key: tuple, probability: float):
+    _score_cache[key] = probability
+    _score_cache.move_to_end(key)
+    if len(_score_cache) > SCORE_CACHE_SIZE:
+        _score_cache.popitem(last=False)
+
+# --- Micro-batching das Predições ---
+class PredictionBatcher:
+    """Junta as linhas que chegam dentro de `max_wait_ms` (até `max_batch`) numa única chamada ao booster."""
+
+    def __init__(self, pool: ThreadPoolExecutor, max_batch: int = 64, max_wait_ms: float = 5):
+        self._pool = pool
+        self._max_batch = max_batch
+        self._max_wait = max_wait_ms / 1000
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task = None
+        # Buffer contíguo reaproveitado entre lotes: só um lote é processado por vez em `_run`.
+        self._buffer = np.empty((max_batch, N_COLUMNS), dtype=np.float32)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def predict(self, x: np.ndarray) -> float:
+        """Enfileira a linha e aguarda a probabilidade calculada no próximo lote."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((x, future))
+        return await future
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        x, future = await self._queue.get()
+        rows, futures = [x], [future]
+        deadline = loop.time() + self._max_wait
+        while len(rows) < self._max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                x, future = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            rows.append(x)
+            futures.append(future)
+        return rows, futures
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            rows, futures = await self._drain()
+            # Uma linha sozinha já é contígua; lotes maiores são copiados para o buffer fixo.
+            batch = rows[0] if len(rows) == 1 else np.concatenate(rows, out=self._buffer[:len(rows)])
+            try:
+                probabilities = await loop.run_in_executor(self._pool, predict_rows, batch)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future, probability in zip(futures, probabilities):
+                if not future.done():
+                    future.set_result(float(probability))
+
+async def score_deal(batcher: PredictionBatcher, deal_data: dict) -> float:
+    """Recebe um dicionário com dados de um negócio e retorna a probabilidade de ganho.
+
+    Único caminho de predição da API: consulta o cache e, se não houver, calcula via batcher.
+    """
+    key = deal_key(deal_data)
+    probability = get_cached_score(key)
+    if probability is None:
+        probability = await batcher.predict(build_features(*key))
+        cache_score(key, probability)
+    return probability
 
 # --- Função para Atualizar o Pipedrive de volta ---
-def update_pipedrive_deal(deal_id: int, score: float):
-    """Atualiza o campo customizado no Pipedrive com o novo score."""
+async def update_pipedrive_deal(client: httpx.AsyncClient, deal_id: int, score: float):
+    """Atualiza o campo customizado no Pipedrive com o novo score, com backoff exponencial em falhas transitórias."""
     if not all([PIPEDRIVE_API_KEY, LEAD_SCORE_FIELD_KEY]):
-        print("AVISO: API Key ou Field Key não configurados. Pipedrive não será atualizado.")
+        logger.warning("AVISO: API Key ou Field Key não configurados. Pipedrive não será atualizado.")
         return
 
-    url = f"https://api.pipedrive.com/v1/deals/{deal_id}?api_token={PIPEDRIVE_API_KEY}"
     payload = {LEAD_SCORE_FIELD_KEY: round(score * 100, 2)}
     
-    try:
-        response = requests.put(url, json=payload)
-        response.raise_for_status()
-        print(f"Pipedrive: Negócio {deal_id} atualizado com score {payload[LEAD_SCORE_FIELD_KEY]}%.")
-    except requests.exceptions.RequestException as e:
-        print(f"ERRO ao atualizar o Pipedrive para o negócio {deal_id}: {e}")
+    for attempt in range(PIPEDRIVE_MAX_RETRIES + 1):
+        try:
+            response = await client.put(f"/v1/deals/{deal_id}", json=payload)
+            response.raise_for_status()
+            logger.info(f"Pipedrive: Negócio {deal_id} atualizado com score {payload[LEAD_SCORE_FIELD_KEY]}%.")
+            return
+        except httpx.HTTPError as e:
+            # Só o status/tipo do erro vai para o log: o texto da exceção traz a URL da requisição.
+            if isinstance(e, httpx.HTTPStatusError):
+                status = e.response.status_code
+                transient = status == 429 or status >= 500
+                reason = f"HTTP {status}"
+            else:
+                transient = True
+                reason = type(e).__name__
+            if not transient or attempt == PIPEDRIVE_MAX_RETRIES:
+                logger.error(f"ERRO ao atualizar o Pipedrive para o negócio {deal_id}: {reason}")
+                return
+            delay = PIPEDRIVE_RETRY_BASE_DELAY * 2 ** attempt
+            logger.warning(f"Pipedrive: falha ao atualizar o negócio {deal_id} ({reason}); nova tentativa em {delay:.1f}s.")
+            await asyncio.sleep(delay)
 
 # --- ENDPOINT PRINCIPAL: Webhook do Pipedrive ---
-@app.post("/webhook/pipedrive")
-async def pipedrive_webhook(request: Request, authenticated: bool = Depends(verify_credentials)):
-    """Recebe notificações do Pipedrive, filtra pelo funil correto, calcula o score e atualiza o negócio."""
+@app.post("/webhook/pipedrive", response_model=StatusResponse)
+async def pipedrive_webhook(request: Request, background_tasks: BackgroundTasks, authenticated: bool = Depends(verify_credentials)):
+    """Recebe notificações do Pipedrive, filtra pelo funil correto, calcula o score e atualiza o negócio.
+
+    A atualização no Pipedrive roda em background, depois da resposta: o webhook não espera a API deles.
+    """
     if not authenticated:
         # Com a função de teste, esta parte nunca será executada, mas a mantemos por estrutura.
         raise HTTPException(status_code=401, detail="Autenticação falhou.")
 
-    webhook_data = await request.json()
+    webhook_data = orjson.loads(await request.body())
     deal_info = webhook_data.get("current", {})
     deal_id = deal_info.get("id")
     pipeline_id = deal_info.get("pipeline_id")
@@ -92,10 +290,10 @@ async def pipedrive_webhook(request: Request, authenticated: bool = Depends(veri
         return {"status": "ok", "message": "Evento sem ID de negócio, ignorado."}
 
     if pipeline_id != TARGET_PIPELINE_ID:
-        print(f"Negócio {deal_id} está no funil {pipeline_id}, não no funil alvo {TARGET_PIPELINE_ID}. Ignorando.")
+        logger.info(f"Negócio {deal_id} está no funil {pipeline_id}, não no funil alvo {TARGET_PIPELINE_ID}. Ignorando.")
         return {"status": "ok", "message": f"Negócio ignorado (funil {pipeline_id})."}
 
-    print(f"Negócio {deal_id} recebido do funil alvo. Processando...")
+    logger.info(f"Negócio {deal_id} recebido do funil alvo. Processando...")
 
     deal_for_model = {
         "valor": deal_info.get("value", 0) or 0,
@@ -106,13 +304,13 @@ async def pipedrive_webhook(request: Request, authenticated: bool = Depends(veri
         "utm_term": deal_info.get("utm_term", "desconhecido"),
     }
 
-    probability = get_prediction_for_deal(deal_for_model)
-    update_pipedrive_deal(deal_id, probability)
+    probability = await score_deal(request.app.state.batcher, deal_for_model)
+    background_tasks.add_task(update_pipedrive_deal, request.app.state.pd_client, deal_id, probability)
     
     return {"status": "ok", "message": f"Negócio {deal_id} processado com sucesso."}
 
 # Endpoint de "saúde" da API para verificar se está no ar
-@app.get("/")
+@app.get("/", response_model=StatusResponse)
 def read_root():
     return {"status": "ok", "message": "API de Lead Scoring em Tempo Real está no ar!"}
 